@@ -5,20 +5,98 @@ and further filtering.
 '''
 
 import cv2 as cv
-import glob
+import functools
+import hashlib
+import io
+import itertools
 import numpy as np
 import os
 import requests
-import shutil
+import tempfile
+import threading
+import time
 
 from astropy.table import Table
-from custom_exceptions import EmptySearch, NotEnoughExposures
-from image_stacking.auto_stack import stackImagesECC
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from custom_exceptions import CorruptImage, EmptySearch, NotEnoughExposures
+from requests.adapters import HTTPAdapter
 from socket import timeout
 from urllib.error import URLError
+from urllib.parse import urlencode
+from urllib3.util.retry import Retry
 
 IMG_EXT = ".jpeg"
 
+# Simple Image Access Protocol endpoint of the Hubble Legacy Archive.
+_HLA_SIAP_URL = "https://hla.stsci.edu/cgi-bin/hlaSIAP.cgi"
+
+# os.cpu_count returns None if the count can't be determined.
+_NUM_CPUS = max(1, os.cpu_count() or 1)
+
+# Make sure OpenCV's SIMD code paths and thread pool are used for filtering,
+# even if they were disabled through the environment. The pool is shared by
+# the whole process rather than created per calling thread: OpenCV runs a
+# parallel call made while the pool is busy sequentially on the calling
+# thread. The _NUM_CPUS location threads of gen_img_set therefore don't
+# each bring a full pool of threads, and they spend much of their time
+# waiting on downloads, so the CPUs aren't oversubscribed.
+cv.setUseOptimized(True)
+cv.setNumThreads(_NUM_CPUS)
+
+# Number of images to download from the HLA concurrently.
+_MAX_DOWNLOAD_WORKERS = 8
+# Size of the buffer used to stream downloaded images to disk.
+_DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+# Connect and read timeouts, in seconds, for image downloads so a stalled
+# transfer is retried instead of hanging its worker.
+_DOWNLOAD_TIMEOUT = (5, 30)
+# Share one session so downloads reuse pooled keep-alive connections. Failed
+# connections and transient server errors are retried with exponential
+# backoff rather than immediately. Once retries run out, the last error
+# response is returned so callers' status checks still apply.
+_SESSION = requests.Session()
+_HTTP_ADAPTER = HTTPAdapter(
+    pool_connections=16, pool_maxsize=16,
+    max_retries=Retry(total=5, backoff_factor=0.3,
+                      status_forcelist=(500, 502, 503, 504),
+                      raise_on_status=False))
+_SESSION.mount("http://", _HTTP_ADAPTER)
+_SESSION.mount("https://", _HTTP_ADAPTER)
+# Cap the number of requests in flight across all threads so concurrent
+# locations don't overwhelm the HLA server.
+_REQUEST_SLOTS = threading.BoundedSemaphore(16)
+
+# Location and lifetime of locally cached HLA query responses.
+_QUERY_CACHE_DIR = os.path.join(os.curdir, ".hla_cache")
+_QUERY_CACHE_EXPIRY_S = 24 * 60 * 60
+# Connect and read timeouts, in seconds, for HLA queries. The read timeout is
+# generous since an all-sky search can take minutes to answer.
+_QUERY_TIMEOUT = (5, 300)
+
+# CLAHE objects and CUDA streams aren't thread safe, and images are processed
+# on several threads at once. Keep one of each per thread.
+_THREAD_STATE = threading.local()
+
+try:
+    # Prefer the NEON-tuned FastCV kernels when OpenCV is built with them,
+    # e.g. on the Raspberry Pi. The recursive bilateral filter runs in
+    # constant time per pixel regardless of the filter radius.
+    _FASTCV_BILATERAL = cv.fastcv.bilateralRecursive
+except AttributeError:
+    _FASTCV_BILATERAL = None
+
+try:
+    # The guided filter from opencv-contrib-python is edge-preserving like the
+    # bilateral filter, but runs in linear time regardless of its radius.
+    _GUIDED_FILTER = cv.ximgproc.guidedFilter
+except AttributeError:
+    _GUIDED_FILTER = None
+
+try:
+    _USE_CUDA = cv.cuda.getCudaEnabledDeviceCount() > 0
+except (AttributeError, cv.error):
+    _USE_CUDA = False
+
 
 def gen_img_set(img_path, process_manually=False, num_img=50):
     """Downloads an processed image for each galaxy and nebula location.
@@ -35,47 +113,62 @@ def gen_img_set(img_path, process_manually=False, num_img=50):
         num_img: Number of images to generate through manual processing.
     """
 
-    def remove_exposures():
-        """Removes exposures from an in-progress image compilation."""
-        exposure_files = glob.glob(os.path.join(img_path,
-                                                "exposure_*" + IMG_EXT))
-        for file in exposure_files:
-            os.remove(file)
+    rng = np.random.default_rng()
+    rand_locs = []
 
     def generate_rand_loc():
-        ra = round(np.random.uniform(0, 360), 3)
-        dec = round(np.rad2deg(np.arcsin(np.random.uniform(-1, 1))), 3)
-        return ra, dec
+        """Pops a random location, sampling a new batch when none are left.
+
+        Not thread safe, callers must hold loc_lock.
+        """
+        if not rand_locs:
+            # Oversample to cover locations rejected by the search.
+            batch_size = 4 * num_img
+            ras = np.round(rng.uniform(0, 360, size=batch_size), 3)
+            decs = np.round(np.rad2deg(np.arcsin(
+                rng.uniform(-1, 1, size=batch_size))), 3)
+            rand_locs.extend(zip(ras.tolist(), decs.tolist()))
+        return rand_locs.pop()
+
+    prev_locs = set()
+    loc_lock = threading.Lock()
+
+    def generate_new_loc():
+        """Pops a random location that hasn't already been searched."""
+        with loc_lock:
+            while True:
+                loc = generate_rand_loc()
+                if loc not in prev_locs:
+                    prev_locs.add(loc)
+                    return loc
+
+    def process_rand_loc():
+        """Generates an image from a randomly sampled location."""
+        ra, dec = generate_new_loc()
+        while True:
+            try:
+                __fetch_img(ra, dec, img_path, processing_manually=True)
+            except (cv.error, CorruptImage, EmptySearch, NotEnoughExposures):
+                # Generate a new location if the search returns
+                # exposures that result in an unrecoverable error.
+                ra, dec = generate_new_loc()
+                continue
+            except (ConnectionError, URLError, timeout,
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout):
+                # Retry the same coordinate pair if the connection fails.
+                continue
+            break
 
     if process_manually:
         # Randomly sample num_img celestial coordinates to pull images of, and
-        # manually process those images locally.
-        prev_locs = []
-        for img_idx in range(num_img):
-            ra, dec = generate_rand_loc()
-
-            while True:
-                if (ra, dec) in prev_locs:
-                    # Generate a new location if the current location has
-                    # already been searched.
-                    ra, dec = generate_rand_loc()
-                    continue
-
-                try:
-                    __fetch_img(ra, dec, img_path, processing_manually=True)
-                except (cv.error, EmptySearch, NotEnoughExposures):
-                    # Generate a new location if the search returns
-                    # exposures that result in an unrecoverable error.
-                    remove_exposures()
-                    ra, dec = generate_rand_loc()
-                    continue
-                except (ConnectionError, URLError, timeout,
-                        requests.exceptions.ConnectionError):
-                    # Retry the same coordinate pair if the connection fails.
-                    continue
-
-                prev_locs.append((ra, dec))
-                break
+        # manually process those images locally. Locations are independent,
+        # so overlap the network and OpenCV work of several at once.
+        with ThreadPoolExecutor(max_workers=_NUM_CPUS) as executor:
+            img_futures = [executor.submit(process_rand_loc)
+                           for _ in range(num_img)]
+            for img_future in img_futures:
+                img_future.result()
     else:
         # Download all high quality images in the Hubble Legacy Archive.
         __all_sky_search("HLSP", img_path)
@@ -94,17 +187,12 @@ def __all_sky_search(img_type, data_path):
                                                       inst="WFC3")
 
     # Group photos by right ascension and declination.
-    grouped_img_urls = {}
-    for entry in all_sky_img_table:
-        img_coords = (entry["RA"], entry["DEC"])
-        if img_coords in grouped_img_urls:
-            grouped_img_urls[img_coords].append(entry["URL"])
-        else:
-            grouped_img_urls[img_coords] = [entry["URL"]]
+    grouped_img_urls = __group_urls_by_loc(all_sky_img_table)
 
     num_imgs = len(grouped_img_urls)
-    for img_urls, img_idx in zip(grouped_img_urls.values(), range(num_imgs)):
-        # Save the first image for each coordinate.
+
+    def save_first_img(img_idx, img_urls):
+        """Saves the first image for a coordinate."""
         img_url = img_urls[0]
         img_path = os.path.join(data_path, "%d%s" % (img_idx, IMG_EXT))
         print("Saving image %s of %s..." % (img_idx + 1, num_imgs))
@@ -112,11 +200,17 @@ def __all_sky_search(img_type, data_path):
             try:
                 __save_img(img_url, img_path)
             except (ConnectionError, URLError, timeout,
-                    requests.exceptions.ConnectionError):
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout):
                 # Retry the same download if the connection fails.
                 continue
             break
 
+    # Overlap the network latency of downloads across several connections.
+    with ThreadPoolExecutor(max_workers=_MAX_DOWNLOAD_WORKERS) as executor:
+        list(executor.map(save_first_img, range(num_imgs),
+                          grouped_img_urls.values()))
+
 
 def __fetch_img(ra, dec, data_path, processing_manually):
     """Downloads a processed image from the Hubble Legacy Archive at (ra, dec).
@@ -131,6 +225,9 @@ def __fetch_img(ra, dec, data_path, processing_manually):
 
     SEARCH_RADIUS = 0.4
     MIN_NUM_EXPOSURES = 5
+    MAX_NUM_STACKING_ATTEMPTS = 3
+    # Exposures are summed in 16 bits, which holds at most 257 8-bit images.
+    MAX_NUM_STACKED_EXPOSURES = 257
     try:
         if processing_manually:
             img_table = __query_hubble_legacy_archive(ra, dec, SEARCH_RADIUS,
@@ -144,87 +241,350 @@ def __fetch_img(ra, dec, data_path, processing_manually):
         print("ERROR: Invalid query options")
 
     # Group photos by right ascension and declination.
-    grouped_img_urls = {}
-    for entry in img_table:
-        exposure_loc = (entry["RA"], entry["DEC"])
-        if exposure_loc in grouped_img_urls:
-            grouped_img_urls[exposure_loc].append(entry["URL"])
-        else:
-            grouped_img_urls[exposure_loc] = [entry["URL"]]
+    grouped_img_urls = __group_urls_by_loc(img_table)
 
     if processing_manually:
-        # Select the location with the most exposures for stacking.
-        loc_index = np.argmax([len(url_list) for url_list in
-                               list(grouped_img_urls.values())])
-        exposure_urls = list(grouped_img_urls.values())[loc_index]
-        if len(exposure_urls) < MIN_NUM_EXPOSURES:
+        # Select the locations with the most exposures for stacking.
+        candidate_locs = [(loc, urls) for loc, urls in sorted(
+            grouped_img_urls.items(), key=lambda item: len(item[1]),
+            reverse=True) if len(urls) >= MIN_NUM_EXPOSURES]
+        candidate_locs = candidate_locs[:MAX_NUM_STACKING_ATTEMPTS]
+        if not candidate_locs:
             raise NotEnoughExposures
 
         print("\nProcessing data for coordinates RA:", str(ra) + "° DEC:",
               str(dec) + "°\n")
 
-        # Download exposures for each position.
-        exposure_count = 0
-        exposure_path_list = []
-        for exposure_url in exposure_urls:
-            exposure_count += 1
-            exposure_path = os.path.join(data_path,
-                                         "exposure_" + str(exposure_count)
-                                         + IMG_EXT)
-            exposure_path_list.append(exposure_path)
-            __save_img(exposure_url, exposure_path)
-
-        # Combine exposures for the chosen location into a single image.
-        combined_img = stackImagesECC(exposure_path_list)
-        ra, dec = list(grouped_img_urls.keys())[loc_index]
+        for attempt_idx, (exposure_loc, exposure_urls) in enumerate(
+                candidate_locs):
+            try:
+                # Download and decode exposures for each position
+                # concurrently, keeping them in memory rather than writing
+                # them to disk. Combine them into a single image as they
+                # arrive so stacking overlaps with the remaining downloads.
+                combined_img = __stack_exposures(
+                    __fetch_decoded_imgs(
+                        exposure_urls[:MAX_NUM_STACKED_EXPOSURES]),
+                    MIN_NUM_EXPOSURES)
+            except (cv.error, CorruptImage, NotEnoughExposures):
+                # Fall back to the next best location from this query before
+                # giving up on the search.
+                if attempt_idx == len(candidate_locs) - 1:
+                    raise
+                continue
+            break
+        ra, dec = exposure_loc
         img_path = os.path.join(data_path, "RA_" + str(ra) + "__DEC_"
                                 + str(dec) + IMG_EXT)
 
-        # Remove downloaded exposures once they've been combined.
-        for exposure_f in exposure_path_list:
-            os.remove(exposure_f)
-
-        filtered_img = cv.bilateralFilter(combined_img, 5, 75, 75)
+        filtered_img = __bilateral_filter(combined_img, 5, 75, 75)
         filtered_img = __enhance_contrast(filtered_img)
         cv.imwrite(img_path, filtered_img)
     else:
         print("\nSaving image for coordinates RA:", str(ra) + "° DEC:",
               str(dec) + "°\n")
         # Save the first image of the first location from the query.
-        ra, dec = list(grouped_img_urls.keys())[0]
-        img_url = list(grouped_img_urls.values())[0][0]
+        (ra, dec), img_urls = next(iter(grouped_img_urls.items()))
+        img_url = img_urls[0]
         img_path = os.path.join(data_path, "RA_" + str(ra) + "__DEC_"
                                 + str(dec) + IMG_EXT)
         __save_img(img_url, img_path)
 
 
-def __enhance_contrast(img_matrix, bins=256):
-    """Applies histogram equalization to improve image contrast.
+def __group_urls_by_loc(img_table):
+    """Groups the image urls of a query table by celestial coordinates.
+
+    Operates on whole table columns rather than iterating over table rows.
 
     Args:
-        TODO(Madison): Summarize these params.
-        bins: ?
-        img_matrix: ?
+        img_table: An astropy Table object returned from an HLA query.
+
+    Returns:
+        A dict mapping each (ra, dec) pair to a list of its image urls, in
+        order of each location's first appearance in the table.
     """
-    img_flattened = img_matrix.flatten()
-    img_hist = np.zeros(bins)
+    if len(img_table) == 0:
+        return {}
+
+    # Number the rows to remember the order of the query.
+    indexed_table = img_table["RA", "DEC", "URL"]
+    indexed_table["ROW"] = np.arange(len(indexed_table))
+    # Sort the table so that each location occupies a contiguous slice. The
+    # sort is stable, so each slice starts with the location's first row.
+    grouped_table = indexed_table.group_by(["RA", "DEC"])
+    group_bounds = grouped_table.groups.indices
+    ras = np.asarray(grouped_table["RA"])
+    decs = np.asarray(grouped_table["DEC"])
+    urls = np.asarray(grouped_table["URL"])
+    first_rows = np.asarray(grouped_table["ROW"])[group_bounds[:-1]]
+
+    grouped_img_urls = {}
+    for group_idx in np.argsort(first_rows):
+        start, end = group_bounds[group_idx], group_bounds[group_idx + 1]
+        grouped_img_urls[(ras[start], decs[start])] = urls[start:end].tolist()
+    return grouped_img_urls
 
-    # Compute the frequency count of each pixel.
-    for pix in img_matrix:
-        img_hist[pix] += 1
 
-    # Normalize the histogram.
-    cum_sum = np.cumsum(img_hist)
-    norm = (cum_sum - cum_sum.min()) * 255
-    n_ = cum_sum.max() - cum_sum.min()
-    uniform_norm = norm / n_
-    uniform_norm = uniform_norm.astype('int')
+def __stack_exposures(exposures, min_num_stacked):
+    """Aligns exposures to the first exposure and averages them together.
+
+    Each exposure is projected onto the principal color axis of the first
+    exposure to form a high contrast single channel image. Projections are
+    registered to the reference with a homography estimated from matched ORB
+    features. If too few features match, they are instead coarsely aligned
+    by phase correlation and refined with an affine ECC transform. Exposures
+    that can't be aligned either way are left out of the stack. Alignment is
+    estimated at half resolution and applied to the full resolution
+    exposures.
+
+    Args:
+        exposures: An iterable of at most 257 8-bit BGR exposures to
+                   combine. Exposures are consumed one at a time, and
+                   besides the exposure being aligned only the reference and
+                   the running sum are kept.
+        min_num_stacked: Minimum number of exposures, including the
+                         reference, that must be aligned and stacked.
 
-    img_eq = uniform_norm[img_flattened]
-    # Reshape the flattened matrix to its original shape.
-    img_eq = np.reshape(a=img_eq, newshape=img_matrix.shape)
+    Returns:
+        The stacked 8-bit BGR image.
+    """
+    exposures = iter(exposures)
+    ref_img = next(exposures)
+    color_axis = __principal_color_axis(ref_img)
+    ref_gray = cv.pyrDown(ref_img.astype(np.float32) @ color_axis)
+
+    orb = cv.ORB_create(nfeatures=500)
+    matcher = cv.BFMatcher(cv.NORM_HAMMING, crossCheck=True)
+    ref_keypoints, ref_descriptors = orb.detectAndCompute(
+        cv.normalize(ref_gray, None, 0, 255, cv.NORM_MINMAX, cv.CV_8U), None)
+
+    height, width = ref_img.shape[:2]
+    # Sum exposures in 16 bits, which is exact for up to 257 8-bit images
+    # and moves half the memory of a float32 sum.
+    stacked_img = ref_img.astype(np.uint16)
+    num_stacked = 1
+    # Reuse one output buffer for every warped exposure.
+    warped_img = np.empty_like(ref_img)
+    for img in exposures:
+        img_gray = cv.pyrDown(img.astype(np.float32) @ color_axis)
+
+        homography = __orb_homography(
+            orb, matcher, ref_keypoints, ref_descriptors,
+            cv.normalize(img_gray, None, 0, 255, cv.NORM_MINMAX, cv.CV_8U))
+        if homography is None:
+            homography = __ecc_homography(ref_gray, img_gray)
+        if homography is None:
+            continue
+        __warp_perspective(img, homography, (width, height), warped_img)
+        np.add(stacked_img, warped_img, out=stacked_img)
+        num_stacked += 1
+    if num_stacked < min_num_stacked:
+        raise NotEnoughExposures
+    stacked_img //= num_stacked
+    return stacked_img.astype(np.uint8)
+
+
+def __orb_homography(orb, matcher, ref_keypoints, ref_descriptors, img_gray):
+    """Estimates a homography between half resolution images from features.
 
-    return img_eq
+    Args:
+        orb: ORB feature detector.
+        matcher: Brute force Hamming distance descriptor matcher.
+        ref_keypoints, ref_descriptors: ORB features of the half resolution
+                                        reference image.
+        img_gray: 8-bit single channel half resolution image to align to the
+                  reference.
+
+    Returns:
+        The full resolution homography mapping the image onto the reference,
+        or None if too few features could be matched consistently.
+    """
+    MIN_NUM_MATCHES = 10
+    RANSAC_REPROJ_THRESHOLD = 5.0
+    # Exposures of one location differ by little more than a shift, so a
+    # transform that scales the image area by more than this factor, or
+    # collapses it, is a bad fit.
+    MAX_AREA_SCALE = 2.0
+
+    keypoints, descriptors = orb.detectAndCompute(img_gray, None)
+    if descriptors is None or ref_descriptors is None:
+        return None
+    matches = matcher.match(descriptors, ref_descriptors)
+    if len(matches) < MIN_NUM_MATCHES:
+        return None
+
+    # Scale keypoints found at half resolution to full resolution.
+    src_pts = 2 * np.float32([keypoints[match.queryIdx].pt
+                              for match in matches])
+    dst_pts = 2 * np.float32([ref_keypoints[match.trainIdx].pt
+                              for match in matches])
+    homography, inlier_mask = cv.findHomography(src_pts, dst_pts, cv.RANSAC,
+                                                RANSAC_REPROJ_THRESHOLD)
+    if homography is None or inlier_mask.sum() < MIN_NUM_MATCHES:
+        return None
+    area_scale = abs(np.linalg.det(homography[:2, :2]))
+    if not 1 / MAX_AREA_SCALE <= area_scale <= MAX_AREA_SCALE:
+        return None
+    return homography
+
+
+def __ecc_homography(ref_gray, img_gray):
+    """Estimates an affine alignment between half resolution images with ECC.
+
+    ECC is seeded with the translation found by phase correlation so it
+    converges in few iterations.
+
+    Args:
+        ref_gray: Single channel half resolution reference image.
+        img_gray: Single channel half resolution image to align to the
+                  reference.
+
+    Returns:
+        The full resolution affine alignment as a homography mapping the
+        image onto the reference, or None if the images don't correlate or
+        ECC doesn't converge.
+    """
+    ECC_CRITERIA = (cv.TERM_CRITERIA_COUNT + cv.TERM_CRITERIA_EPS, 50, 1e-4)
+    ECC_GAUSS_FILT_SIZE = 5
+    MIN_PHASE_CORRELATION = 0.1
+
+    (dx, dy), response = cv.phaseCorrelate(ref_gray, img_gray)
+    if response < MIN_PHASE_CORRELATION:
+        return None
+    warp_matrix = np.array([[1, 0, dx], [0, 1, dy]], dtype=np.float32)
+    try:
+        _, warp_matrix = cv.findTransformECC(ref_gray, img_gray, warp_matrix,
+                                             cv.MOTION_AFFINE, ECC_CRITERIA,
+                                             None, ECC_GAUSS_FILT_SIZE)
+    except cv.error:
+        # ECC raises rather than returning when it fails to converge.
+        return None
+    # Translation doubles at full resolution, the linear part doesn't.
+    warp_matrix[:, 2] *= 2
+    # ECC maps reference coordinates into the image, so invert it.
+    return np.linalg.inv(np.vstack([warp_matrix, [0, 0, 1]]))
+
+
+def __warp_perspective(img_matrix, homography, dsize, dst):
+    """Warps an image with a homography, on the GPU if CUDA is available.
+
+    Args:
+        img_matrix: Image to warp.
+        homography: 3x3 transform mapping the image to the output.
+        dsize: (width, height) of the output image.
+        dst: Preallocated output image.
+
+    Returns:
+        The warped image, stored in dst.
+    """
+    if _USE_CUDA:
+        cuda_stream = __cuda_stream()
+        gpu_img = cv.cuda_GpuMat()
+        gpu_img.upload(img_matrix, stream=cuda_stream)
+        gpu_warped = cv.cuda.warpPerspective(gpu_img, homography, dsize,
+                                             stream=cuda_stream)
+        gpu_warped.download(stream=cuda_stream, dst=dst)
+        cuda_stream.waitForCompletion()
+        return dst
+    return cv.warpPerspective(img_matrix, homography, dsize, dst=dst)
+
+
+def __cuda_stream():
+    """Returns the calling thread's CUDA stream, creating it on first use.
+
+    Reusing a stream avoids creating one per image, and giving each thread
+    its own keeps threads from waiting on each other's GPU work.
+    """
+    cuda_stream = getattr(_THREAD_STATE, "cuda_stream", None)
+    if cuda_stream is None:
+        cuda_stream = cv.cuda_Stream()
+        _THREAD_STATE.cuda_stream = cuda_stream
+    return cuda_stream
+
+
+def __principal_color_axis(img_matrix, stride=4):
+    """Finds the color direction along which an image varies the most.
+
+    Args:
+        img_matrix: An 8-bit BGR image.
+        stride: Spacing between the pixels sampled to estimate color
+                covariance.
+
+    Returns:
+        A unit length float32 vector of BGR weights.
+    """
+    pixels = img_matrix[::stride, ::stride].reshape(-1, 3)
+    # Eigenvalues are returned in ascending order.
+    _, eig_vecs = np.linalg.eigh(np.cov(pixels, rowvar=False))
+    return eig_vecs[:, -1].astype(np.float32)
+
+
+def __bilateral_filter(img_matrix, diameter, sigma_color, sigma_space):
+    """Applies an edge-preserving bilateral filter to an image.
+
+    Uses the fastest edge-preserving filter available to the installed OpenCV
+    build, falling back to cv.bilateralFilter.
+
+    Args:
+        img_matrix: An 8-bit image to filter.
+        diameter: Diameter of each pixel neighborhood.
+        sigma_color, sigma_space: Standard deviations of the filter in color
+                                  and coordinate space.
+    """
+    if _USE_CUDA:
+        cuda_stream = __cuda_stream()
+        gpu_img = cv.cuda_GpuMat()
+        gpu_img.upload(img_matrix, stream=cuda_stream)
+        gpu_filtered = cv.cuda.bilateralFilter(gpu_img, diameter, sigma_color,
+                                               sigma_space,
+                                               stream=cuda_stream)
+        filtered_img = gpu_filtered.download(stream=cuda_stream)
+        cuda_stream.waitForCompletion()
+        return filtered_img
+    if _FASTCV_BILATERAL is not None:
+        # FastCV only supports single channel images, so filter each channel
+        # separately. The recursive filter takes a color sigma normalized to
+        # [0, 1] and uses its default spatial sigma, so the diameter is not
+        # needed.
+        return cv.merge([_FASTCV_BILATERAL(channel,
+                                           sigmaColor=sigma_color / 255)
+                         for channel in cv.split(img_matrix)])
+    if _GUIDED_FILTER is not None:
+        # Self-guided filtering smooths regions with a variance below eps
+        # while keeping stronger edges, mirroring the color sigma.
+        return _GUIDED_FILTER(img_matrix, img_matrix, diameter // 2,
+                              sigma_color ** 2)
+    return cv.bilateralFilter(img_matrix, diameter, sigma_color, sigma_space)
+
+
+def __enhance_contrast(img_matrix, use_clahe=True):
+    """Applies histogram equalization to improve image contrast.
+
+    Only the luminance of color images is equalized so that colors are
+    preserved.
+
+    Args:
+        img_matrix: An 8-bit grayscale or BGR image to equalize.
+        use_clahe: If true, equalize adaptively over tiles of the image
+                   rather than over the global histogram.
+    """
+
+    def equalize(channel):
+        # Adaptive equalization keeps large regions of empty sky from
+        # dominating the intensity distribution.
+        if use_clahe:
+            clahe = getattr(_THREAD_STATE, "clahe", None)
+            if clahe is None:
+                clahe = cv.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+                _THREAD_STATE.clahe = clahe
+            return clahe.apply(channel)
+        return cv.equalizeHist(channel)
+
+    if img_matrix.ndim == 2:
+        return equalize(img_matrix)
+    luma, cr, cb = cv.split(cv.cvtColor(img_matrix, cv.COLOR_BGR2YCrCb))
+    return cv.cvtColor(cv.merge((equalize(luma), cr, cb)),
+                       cv.COLOR_YCrCb2BGR)
 
 
 def __save_img(url, path):
@@ -234,16 +594,80 @@ def __save_img(url, path):
         url: Location to download image from.
         path: Location to save image to locally.
     """
-    req = requests.get(url, stream=True)
+    OK_STATUS = 200
+    # Closing the response returns its connection to the session's pool.
+    with _REQUEST_SLOTS, _SESSION.get(
+            url, stream=True, timeout=_DOWNLOAD_TIMEOUT) as req:
+        # Ensure the HTTPS reply's status code indicates success (OK status).
+        if req.status_code != OK_STATUS:
+            raise ConnectionError()
+        # iter_content raises stalled or broken transfers as requests
+        # exceptions, so they are retried like other connection failures.
+        with open(path, "wb", buffering=_DOWNLOAD_BUFFER_SIZE) as img_file:
+            for chunk in req.iter_content(_DOWNLOAD_BUFFER_SIZE):
+                img_file.write(chunk)
+
+
+def __fetch_decoded_imgs(urls):
+    """Downloads and decodes images concurrently.
+
+    The image from the first url is always yielded first, so that it can
+    serve as a fixed reference. The rest are yielded in order of completion,
+    so one slow download doesn't hold back the others. At most
+    _MAX_DOWNLOAD_WORKERS downloads are in flight at once, so decoded images
+    that haven't been consumed yet don't pile up in memory.
+
+    Args:
+        urls: Locations to download images from.
+
+    Yields:
+        The decoded 8-bit BGR images.
+    """
+    urls = iter(urls)
+    with ThreadPoolExecutor(max_workers=_MAX_DOWNLOAD_WORKERS) as executor:
+        img_futures = [executor.submit(__fetch_decoded_img, url)
+                       for url in itertools.islice(urls,
+                                                   _MAX_DOWNLOAD_WORKERS)]
+        if not img_futures:
+            return
+        first_img = img_futures[0].result()
+        pending_imgs = set(img_futures[1:])
+        for url in itertools.islice(urls, 1):
+            pending_imgs.add(executor.submit(__fetch_decoded_img, url))
+        yield first_img
+
+        while pending_imgs:
+            done_imgs, pending_imgs = wait(pending_imgs,
+                                           return_when=FIRST_COMPLETED)
+            for img_future in done_imgs:
+                # Start the next download before handing this image over.
+                for url in itertools.islice(urls, 1):
+                    pending_imgs.add(
+                        executor.submit(__fetch_decoded_img, url))
+                yield img_future.result()
+
+
+def __fetch_decoded_img(url):
+    """Downloads and decodes the image from a given url in memory.
+
+    Args:
+        url: Location to download image from.
+
+    Returns:
+        The decoded 8-bit BGR image.
+    """
+    with _REQUEST_SLOTS:
+        req = _SESSION.get(url, timeout=_DOWNLOAD_TIMEOUT)
     OK_STATUS = 200
     # Ensure the HTTPS reply's status code indicates success (OK status).
-    if req.status_code == OK_STATUS:
-        req.raw.decode_content = True
-    else:
+    if req.status_code != OK_STATUS:
         raise ConnectionError()
-    img_file = open(path, "wb")
-    shutil.copyfileobj(req.raw, img_file)
-    img_file.close()
+    img = cv.imdecode(np.frombuffer(req.content, np.uint8), cv.IMREAD_COLOR)
+    if img is None:
+        # Downloading the same image again would give the same result, so
+        # don't report this as a connection failure to be retried.
+        raise CorruptImage
+    return img
 
 
 def __query_hubble_legacy_archive(ra, dec, radius, data_product,
@@ -273,32 +697,63 @@ def __query_hubble_legacy_archive(ra, dec, radius, data_product,
     if not isinstance(spectral_elements, str):
         spectral_elements = ",".join(spectral_elements)
 
-    if ra == 0 and dec == 0 and radius == 180:
-        # Perform an all-sky search.
-        archive_search_url = ("https://hla.stsci.edu/cgi-bin/hlaSIAP.cgi?"
-                              + "POS=0,0"
-                              + "&size=180"
-                              + "&imagetype={data_product}"
-                              + "&inst={inst}"
-                              + "&format=image/jpeg"
-                              + "&autoscale={autoscale}"
-                              + "&asinh={asinh}").format(**locals())
-        if spectral_elements != "":
-            archive_search_url += "&spectral_elt={spectral_elements}".format(
-                **locals()
-            )
-    else:
-        # Fetch jpeg images only in query.
-        archive_search_url = ("https://hla.stsci.edu/cgi-bin/hlaSIAP.cgi?"
-                              + "POS={ra},{dec}"
-                              + "&size={radius}"
-                              + "&imagetype={data_product}"
-                              + "&inst={inst}"
-                              + "&format=image/jpeg"
-                              + "&autoscale={autoscale}"
-                              + "&asinh={asinh}").format(**locals())
-        if spectral_elements != "":
-            archive_search_url += "&spectral_elt={spectral_elements}".format(
-                **locals()
-            )
-    return Table.read(archive_search_url, format="votable")
+    query_params = {"POS": "%s,%s" % (ra, dec),
+                    "size": radius,
+                    "imagetype": data_product,
+                    "inst": inst,
+                    # Fetch jpeg images only in query.
+                    "format": "image/jpeg",
+                    "autoscale": autoscale,
+                    "asinh": asinh}
+    if spectral_elements != "":
+        query_params["spectral_elt"] = spectral_elements
+    # Leave commas and slashes unescaped, as the HLA documents its queries.
+    query_string = urlencode(query_params, safe=",/")
+    archive_search_url = _HLA_SIAP_URL + "?" + query_string
+    return __read_votable(archive_search_url)
+
+
+@functools.lru_cache(maxsize=256)
+def __read_votable(url):
+    """Reads a VOTable from a url, reusing a recently cached copy if present.
+
+    Parsed tables are also kept in memory so repeated queries within a run
+    skip parsing. Callers must not modify the returned table.
+
+    Args:
+        url: Location to download the VOTable from.
+
+    Returns:
+        An astropy Table object parsed from the VOTable.
+    """
+    url_hash = hashlib.sha1(url.encode()).hexdigest()
+    cache_path = os.path.join(_QUERY_CACHE_DIR, url_hash + ".xml")
+    if (os.path.exists(cache_path)
+            and time.time() - os.path.getmtime(cache_path)
+            < _QUERY_CACHE_EXPIRY_S):
+        return Table.read(cache_path, format="votable")
+
+    with _REQUEST_SLOTS:
+        req = _SESSION.get(url, timeout=_QUERY_TIMEOUT)
+    OK_STATUS = 200
+    if req.status_code != OK_STATUS:
+        raise ConnectionError()
+
+    # Parse the response before caching it so that an invalid VOTable is
+    # never stored.
+    img_table = Table.read(io.BytesIO(req.content), format="votable")
+
+    # Write to a temporary file first so a partially written response is
+    # never read back from the cache. Each writer gets its own temporary
+    # file, since threads may fetch the same url concurrently.
+    os.makedirs(_QUERY_CACHE_DIR, exist_ok=True)
+    tmp_cache_fd, tmp_cache_path = tempfile.mkstemp(suffix=".tmp",
+                                                    dir=_QUERY_CACHE_DIR)
+    try:
+        with os.fdopen(tmp_cache_fd, "wb") as cache_f:
+            cache_f.write(req.content)
+        os.replace(tmp_cache_path, cache_path)
+    except OSError:
+        os.remove(tmp_cache_path)
+        raise
+    return img_table
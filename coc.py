@@ -14,3 +14,4 @@ if __name__ == "__main__":
 
     portal = ClientPortal(server_hostname=args.server)
     portal.make_request(args.Input, args.Output)
+    portal.close()
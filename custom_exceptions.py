@@ -6,3 +6,7 @@ class EmptySearch(Exception):
 
 class NotEnoughExposures(Exception):
     pass
+
+
+class CorruptImage(Exception):
+    pass
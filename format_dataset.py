@@ -4,6 +4,8 @@ no files exist in the dataset without a corresponding label.
 
 import os
 
+from concurrent.futures import ThreadPoolExecutor
+
 DATASET_ROOT_DIR = os.path.join(os.curdir, "dataset")
 
 LABEL_DIR = os.path.join(DATASET_ROOT_DIR, "labels")
@@ -15,28 +17,38 @@ data_Id = 0
 for subdir in subdirs:
     label_subdir = os.path.join(LABEL_DIR, subdir)
     # Generate a list of all label files for the given subset of data.
-    label_Ids = [int(f_name.split(".")[0]) for f_name in
-                 os.listdir(label_subdir) if f_name != "classes.txt"]
+    with os.scandir(label_subdir) as entries:
+        label_Ids = [int(entry.name.split(".")[0]) for entry in entries
+                     if entry.is_file() and entry.name != "classes.txt"]
     label_Ids.sort()
     label_Ids = [str(Id) for Id in label_Ids]
+    # Use a set for constant time membership checks.
+    label_Id_set = set(label_Ids)
 
     data_subdir = os.path.join(DATA_DIR, subdir)
-    data = os.listdir(data_subdir)
+    with os.scandir(data_subdir) as entries:
+        data = [entry.name for entry in entries if entry.is_file()]
     for f_name in data:
         datum_Id = f_name.split(".")[0]
-        if datum_Id not in label_Ids:
+        if datum_Id not in label_Id_set:
             # Remove all data that don't have a corresponding label.
             rm_datum_path = os.path.join(data_subdir, datum_Id) + ".jpeg"
             os.remove(rm_datum_path)
 
+    # Plan to rename each label/datum pair with a unique ID.
+    old_names, tmp_names, new_names = [], [], []
     for old_label_Id in label_Ids:
-        # Rename each label/datum pair with a unique ID.
-        old_datum_name = os.path.join(data_subdir, old_label_Id) + ".jpeg"
-        new_datum_name = os.path.join(data_subdir, str(data_Id)) + ".jpeg"
-        os.rename(old_datum_name, new_datum_name)
-
-        old_label_name = os.path.join(label_subdir, old_label_Id) + ".txt"
-        new_label_name = os.path.join(label_subdir, str(data_Id)) + ".txt"
-        os.rename(old_label_name, new_label_name)
-
+        for subdir_path, ext in ((data_subdir, ".jpeg"),
+                                 (label_subdir, ".txt")):
+            old_names.append(os.path.join(subdir_path, old_label_Id) + ext)
+            tmp_names.append(os.path.join(subdir_path, "_tmp_" + old_label_Id)
+                             + ext)
+            new_names.append(os.path.join(subdir_path, str(data_Id)) + ext)
         data_Id += 1
+
+    # A new ID may match an old ID that hasn't been renamed yet, so move every
+    # file to a temporary name before giving it its new name. Renames within
+    # each pass never collide, so they can be issued concurrently.
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(os.replace, old_names, tmp_names))
+        list(executor.map(os.replace, tmp_names, new_names))
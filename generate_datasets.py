@@ -40,6 +40,8 @@ def create_datasets(processing_manually=False, num_imgs=50,
     # Fetch data from the Hubble Legacy Archive.
     gen_img_set(img_path, process_manually=processing_manually,
                 num_img=num_imgs)
+    # Subsets are created inside img_path, so images can be renamed in place
+    # rather than copied.
     imgs = glob.glob(os.path.join(img_path, "*%s" % IMG_EXT))
     random.shuffle(imgs)
     num_samples = len(imgs)
@@ -49,26 +51,26 @@ def create_datasets(processing_manually=False, num_imgs=50,
     training_imgs = imgs[:num_train]
     training_img_path = os.path.join(img_path, "training_dataset")
     os.mkdir(training_img_path)
-    for img, img_idx in zip(training_imgs, range(num_train)):
-        shutil.move(img, os.path.join(training_img_path,
-                                      str(img_idx) + IMG_EXT))
+    for img_idx, img in enumerate(training_imgs):
+        os.replace(img, os.path.join(training_img_path,
+                                     str(img_idx) + IMG_EXT))
 
     # Create a validation data subset.
     num_val = math.floor(validation_portion * num_samples)
     validation_imgs = imgs[num_train:num_train + num_val]
     validation_img_path = os.path.join(img_path, "validation_dataset")
     os.mkdir(validation_img_path)
-    for img, img_idx in zip(validation_imgs, range(num_val)):
-        shutil.move(img, os.path.join(validation_img_path,
-                                      str(img_idx) + IMG_EXT))
+    for img_idx, img in enumerate(validation_imgs):
+        os.replace(img, os.path.join(validation_img_path,
+                                     str(img_idx) + IMG_EXT))
 
     # Create a testing data subset.
     num_test = math.ceil(test_portion * num_samples)
     testing_imgs = imgs[-num_test:]
     test_img_path = os.path.join(img_path, "testing_dataset")
     os.mkdir(test_img_path)
-    for img, img_idx in zip(testing_imgs, range(num_test)):
-        shutil.move(img, os.path.join(test_img_path, str(img_idx) + IMG_EXT))
+    for img_idx, img in enumerate(testing_imgs):
+        os.replace(img, os.path.join(test_img_path, str(img_idx) + IMG_EXT))
 
 
 if __name__ == "__main__":
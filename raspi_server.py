@@ -1,29 +1,88 @@
 # Test the ServerPortal object.
 
 from send_data import ServerPortal
-from shutil import rmtree
+from queue import Queue
+from threading import Thread
+import cv2
+import numpy as np
 import os
-from detect import run
+import torch
+from models.common import DetectMultiBackend
+from utils.augmentations import letterbox
+from utils.general import check_img_size, non_max_suppression, scale_coords
+from utils.plots import Annotator, colors
+from utils.torch_utils import select_device
 
 coc_weights = 'weights/coc_weights.pt'
 input_images = 'images_to_label'
 output_images = 'labeled_images'
+# Number of received images that may wait to be labelled.
+max_queued_images = 2
+
+# Load the model once up front rather than for every request.
+device = select_device('')
+model = DetectMultiBackend(coc_weights, device=device)
+img_size = check_img_size((640, 640), s=model.stride)
+model.warmup(imgsz=(1, 3, *img_size))
 
 server = ServerPortal()
+received_images = Queue(maxsize=max_queued_images)
+
+
+@torch.no_grad()
+def label_image(image_path, labeled_image_path):
+    # Run the same preprocessing, inference, and annotation as detect.run
+    # with its default settings, using the already loaded model.
+    image = cv2.imread(image_path)
+    model_input = letterbox(image, img_size, stride=model.stride,
+                            auto=model.pt)[0]
+    # Convert from HWC to CHW, and from BGR to RGB.
+    model_input = np.ascontiguousarray(model_input.transpose((2, 0, 1))[::-1])
+    model_input = torch.from_numpy(model_input).to(device).float()[None] / 255
+
+    detections = non_max_suppression(model(model_input), conf_thres=0.25,
+                                     iou_thres=0.45, max_det=1000)[0]
+    annotator = Annotator(image, line_width=3, example=str(model.names))
+    if len(detections):
+        detections[:, :4] = scale_coords(model_input.shape[2:],
+                                         detections[:, :4],
+                                         image.shape).round()
+        for *xyxy, conf, cls in reversed(detections):
+            c = int(cls)
+            annotator.box_label(xyxy, f'{model.names[c]} {conf:.2f}',
+                                color=colors(c, True))
+    cv2.imwrite(labeled_image_path, annotator.result())
+
+
+def receive_images():
+    # Receive the next request while the previous image is being labelled.
+    # Each image is saved under its own name so queued images aren't
+    # overwritten.
+    image_count = 0
+    while True:
+        image_name = 'recv_%d.jpeg' % image_count
+        conn = server.recv(os.path.join(input_images, image_name))
+        received_images.put((image_name, conn))
+        image_count += 1
 
-image_name = 'recv.jpeg'
 
-received_img = os.path.join(input_images, image_name)
+os.makedirs(input_images, exist_ok=True)
+os.makedirs(output_images, exist_ok=True)
+Thread(target=receive_images, daemon=True).start()
 
 while True:
-    server.recv(received_img)
+    image_name, conn = received_images.get()
+    received_img = os.path.join(input_images, image_name)
+    labeled_img = os.path.join(output_images, image_name)
 
-    run(weights=coc_weights,  # model.pt path(s)
-            source=input_images,  # file/dir/URL/glob, 0 for webcam
-            project=output_images,  # save results to project/name
-            name=".",  # save results to project/name
-            )
+    label_image(received_img, labeled_img)
 
-    server.send(os.path.join(output_images, image_name))
+    try:
+        server.send(labeled_img, conn)
+    except OSError:
+        # The client disconnected before its response was ready.
+        pass
 
-    rmtree(output_images)
+    # Keep both directories, and only remove this request's images.
+    os.remove(received_img)
+    os.remove(labeled_img)
@@ -4,15 +4,78 @@ Set up a TCP connection between a server and client.
 """
 
 import os
-import re
 import socket
-import subprocess
+import struct
+import threading
 
 
-_CONNECTION_BUFFER_SIZE = 4096
+# Read multi-megabyte images off the socket in large chunks to keep the number
+# of recv and write calls low.
+_CONNECTION_BUFFER_SIZE = 1 << 18
+# Each file is sent as its size in bytes followed by its contents, so that a
+# connection can carry any number of files in both directions.
+_FILE_SIZE_HEADER = struct.Struct("!Q")
 _SERVER_PORT = 5001
 
 
+def _disable_nagle(sock):
+    """Sends small segments, such as the end of a file, without waiting.
+
+    Otherwise the last segment of each file can be held back until the
+    previous one is acknowledged, which adds a delayed ACK to every transfer.
+    """
+
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def _send_file(sock, f):
+    """Sends a file's size followed by its contents over a socket."""
+
+    with open(f, "rb") as data_f:
+        sock.sendall(_FILE_SIZE_HEADER.pack(os.fstat(data_f.fileno()).st_size))
+        # socket.sendfile hands the whole file to os.sendfile, so the data is
+        # copied to the socket by the kernel without passing through Python.
+        sock.sendfile(data_f)
+
+
+def _recv_exactly(sock, num_bytes):
+    """Reads exactly num_bytes from a socket, or fewer if it is closed."""
+
+    data = bytearray()
+    while len(data) < num_bytes:
+        chunk = sock.recv(num_bytes - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def _recv_file(sock, f):
+    """Saves a file sent with _send_file.
+
+    Returns False if the connection was closed before a file was sent.
+    """
+
+    header = _recv_exactly(sock, _FILE_SIZE_HEADER.size)
+    if not header:
+        return False
+    if len(header) < _FILE_SIZE_HEADER.size:
+        raise ConnectionError("Connection closed during transfer")
+    num_bytes_left, = _FILE_SIZE_HEADER.unpack(header)
+
+    # Write image data locally from the socket with a buffer. Receiving into
+    # one preallocated buffer avoids creating a bytes object for each chunk.
+    buffer = memoryview(bytearray(_CONNECTION_BUFFER_SIZE))
+    with open(f, "wb") as data_f:
+        while num_bytes_left:
+            num_bytes = sock.recv_into(buffer[:num_bytes_left])
+            if not num_bytes:
+                raise ConnectionError("Connection closed during transfer")
+            data_f.write(buffer[:num_bytes])
+            num_bytes_left -= num_bytes
+    return True
+
+
 class ServerPortal:
     def __init__(self, save_dir=os.curdir):
         """Inits a server object bound to all available interfaces."""
@@ -20,34 +83,82 @@ class ServerPortal:
         self.recv_data_count = 0
         self.save_dir = save_dir
         self.conn = None
+        # Responses may be sent on a different thread than requests are
+        # received on. Track how many responses each connection is still
+        # owed so that a connection is only closed once all are sent.
+        self.conn_lock = threading.Lock()
+        self.num_unsent_responses = {}
+        self.finished_conns = set()
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.bind(('', _SERVER_PORT))
         self.socket.listen()
 
     def recv(self, save_f):
-        """Waits for a connection request, and saves a received image file."""
+        """Waits for a client request, and saves a received image file.
+
+        A client stays connected across requests. Once it disconnects, the
+        next connection request is accepted. Returns the connection the image
+        arrived on so that a response can be sent on it while later requests
+        are being received.
+        """
 
-        self.conn, _ = self.socket.accept()
-        img_f = open(save_f, "wb")
-        # Accept,  write image data locally from the client with a buffer.
         while True:
-            data = self.conn.recv(_CONNECTION_BUFFER_SIZE)
-            if not data:
+            if self.conn is None:
+                self.conn, _ = self.socket.accept()
+                _disable_nagle(self.conn)
+                with self.conn_lock:
+                    self.num_unsent_responses[self.conn] = 0
+            try:
+                received = _recv_file(self.conn, save_f)
+            except OSError:
+                # Drop clients that disconnect mid-transfer.
+                received = False
+            if received:
                 break
-            img_f.write(data)
-        img_f.close()
+            self.__finish(self.conn)
+            self.conn = None
+        with self.conn_lock:
+            self.num_unsent_responses[self.conn] += 1
         self.recv_data_count += 1
-        return True
+        return self.conn
+
+    def send(self, f, conn=None):
+        """Sends file data to an accepted connection.
 
-    def send(self, f):
-        """Sends file data to an accepted connection."""
+        Responds on conn if given, or else the current connection.
+        """
 
-        if not self.conn:
+        if conn is None:
+            conn = self.conn
+        if not conn:
             raise ConnectionError("Request to send to non-existent client")
 
-        data_f = open(f, "rb")
-        self.conn.sendfile(data_f)
-        self.conn.close()
+        try:
+            _send_file(conn, f)
+        finally:
+            with self.conn_lock:
+                self.num_unsent_responses[conn] -= 1
+                close_conn = (conn in self.finished_conns
+                              and not self.num_unsent_responses[conn])
+                if close_conn:
+                    del self.num_unsent_responses[conn]
+                    self.finished_conns.remove(conn)
+            if close_conn:
+                conn.close()
+
+    def __finish(self, conn):
+        """Closes a connection the client is done with once it is answered.
+
+        If responses are still owed on the connection, send closes it after
+        the last one instead.
+        """
+
+        with self.conn_lock:
+            if self.num_unsent_responses[conn]:
+                self.finished_conns.add(conn)
+                return
+            del self.num_unsent_responses[conn]
+        conn.close()
 
 
 class ClientPortal:
@@ -60,45 +171,28 @@ class ClientPortal:
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
         try:
-            # Use the ping subprocess to get the IP address of Raspberry Pi.
-            response = subprocess.check_output(
-                ["ping", "-c", '3', server_hostname],
-                stderr=subprocess.STDOUT,
-                universal_newlines=True
-            )
-        except subprocess.CalledProcessError:
-            raise ConnectionAbortedError("Unable to establish connection")
-
-        # Parse the repsonse from ping to collect the IPv4 address.
-        if response == '':
-            raise ConnectionAbortedError("Unable to establish connection")
-        server_addr = re.search(
-            '(?:[0-9]{1,3}\.){3}[0-9]{1,3}|$',
-            response
-        ).group()
-        if server_addr == '':
+            # Resolve the IPv4 address of the Raspberry Pi. This goes through
+            # the same system resolver ping uses, without spawning it.
+            server_addr = socket.gethostbyname(server_hostname)
+        except socket.gaierror:
             raise ConnectionAbortedError("Unable to establish connection")
 
         # Connect the socket to the client using the collect IP address.
         self.socket.connect((server_addr, _SERVER_PORT))
+        _disable_nagle(self.socket)
 
     def make_request(self, send_f, recv_f):
-        """Sends an image to the server to be processed and saves response."""
+        """Sends an image to the server to be processed and saves response.
 
-        req_f = open(send_f, "rb")
-        self.socket.sendfile(req_f)
-        req_f.close()
-
-        # Tell the server that it's done sending data, but can still receive.
-        self.socket.shutdown(socket.SHUT_WR)
+        The connection is kept open, so several requests may be made in turn.
+        """
 
+        _send_file(self.socket, send_f)
         # Receive and save the server's response.
-        resp_f = open(recv_f, "wb")
-        with self.socket:
-            # Accept,  write image data locally from the client with a buffer.
-            while True:
-                data = self.socket.recv(_CONNECTION_BUFFER_SIZE)
-                if not data:
-                    break
-                resp_f.write(data)
-        resp_f.close()
+        if not _recv_file(self.socket, recv_f):
+            raise ConnectionError("Server closed the connection")
+
+    def close(self):
+        """Closes the connection to the server."""
+
+        self.socket.close()